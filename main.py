@@ -109,7 +109,9 @@ def main():
         wandb.init(project='hd_gait_detection_with_ssl')
     if args.preprocess_mode:
         #iterate over subjects and preprocess the data
-        win_data_all_sub = np.empty((0,3,WINDOW_SIZE)) 
+        # the windows of each subject are concatenated once, in float32, after the loop
+        win_data_list = []
+        num_windows = 0
         if args.model_type == 'classification':
             win_labels_all_sub = win_subjects = all_subjects = win_chorea_all_sub = win_shift_all_sub = np.empty((0,1))
         elif  args.model_type == 'segmentation':
@@ -146,20 +148,8 @@ def main():
                 try:
                     # remove lines with empty string
                     acc_data = data_file['arr_0']
-                    def is_numeric(s):
-                        try:
-                            float(s)
-                            return True
-                        except ValueError:
-                            return False
-                    # Convert non-numeric strings to np.nan
-                    numeric_mask = np.array([[is_numeric(cell) for cell in row] for row in acc_data])
-                    # numeric_mask = np.char.isnumeric(acc_data) | np.char.isdecimal(acc_data)
-                    acc_data[~numeric_mask] = np.nan
-                    acc_data = acc_data.astype('float')
-                    acc_data = acc_data[~np.isnan(acc_data).any(axis=1)]
-                    if len(acc_data) == 0:
-                        continue
+                    # Convert the strings to floats, non-numeric strings become np.nan
+                    acc_data = preprocessing.strings_to_float(acc_data)
                 except:  
                     print(f"failed to open {file}")                  
                     continue
@@ -170,6 +160,15 @@ def main():
             if args.cohort == 'hc' and chorea is not None:
                chorea[chorea==-1] = 0 
             video_time = data_file.get('arr_3', None)
+            # remove the rows with missing or non-numeric samples (stored as nan) from the data and from the
+            # labels synced to it, so they stay aligned
+            nan_rows = np.isnan(acc_data).reshape(len(acc_data), -1).any(axis=1)
+            if nan_rows.any():
+                acc_data = acc_data[~nan_rows]
+                labels, chorea, video_time = [arr[~nan_rows] if arr is not None and len(arr) == len(nan_rows) else arr
+                                              for arr in (labels, chorea, video_time)]
+            if len(acc_data) == 0:
+                continue
             subject_name = file.split('.')[0]
             
             if args.cohort == 'pd_owly':
@@ -186,12 +185,13 @@ def main():
                                                                                 std_th=STD_THRESH,model_type=args.model_type,subject=subject_name)
             # Concat the data and labels of the different subjects
             
-            win_data_all_sub = np.append(win_data_all_sub, data, axis=0)
+            win_data_list.append(data)
+            num_windows += len(data)
             win_labels_all_sub = np.append(win_labels_all_sub, labels, axis=0)
             win_chorea_all_sub = np.append(win_chorea_all_sub, chorea, axis=0)
             win_shift_all_sub = np.append(win_shift_all_sub, shift, axis=0)
             win_video_time_all_sub = np.append(win_video_time_all_sub, video_time, axis=0)
-            print(file,win_data_all_sub.shape)
+            print(file,(num_windows, 3, WINDOW_SIZE))
             # Create subject vector that will use for group the data in the training
             subject = np.tile(subject_name, (len(labels), 1)).reshape(-1, 1)
             win_subjects = np.append(win_subjects, subject)
@@ -216,6 +216,7 @@ def main():
                 pickle.dump(NumWinSub, outputFile)
          
            '''
+        win_data_all_sub = np.concatenate(win_data_list, axis=0, dtype=np.float32) if win_data_list else np.empty((0,3,WINDOW_SIZE), dtype=np.float32)
         # Save the data, labels and groups
         res = {'win_data_all_sub': win_data_all_sub,
                'win_labels_all_sub': win_labels_all_sub,
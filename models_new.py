@@ -117,6 +117,7 @@ class GaitDetectorSSL:
             batch_size=params['batch_size'],
             shuffle=True,
             num_workers=1,
+            pin_memory=torch.device(self.device).type == 'cuda',
         )
 
         val_loader = DataLoader(
@@ -124,6 +125,7 @@ class GaitDetectorSSL:
             batch_size=params['batch_size'],
             shuffle=False,
             num_workers=1,
+            pin_memory=torch.device(self.device).type == 'cuda',
         )
         if wandb_flag:
             wandb.log({"augmentation":  np.mean(augmentation)})
@@ -176,6 +178,7 @@ class GaitDetectorSSL:
             batch_size=params['batch_size'],
             shuffle=False,
             num_workers=1,
+            pin_memory=torch.device(self.device).type == 'cuda',
         )
 
         model = self._get_model(pretrained=False)
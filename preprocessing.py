@@ -1,21 +1,82 @@
+from fractions import Fraction
 import numpy as np
 from numpy.lib.stride_tricks import sliding_window_view
 import torch
+try:
+    from numba import njit, prange
+except ImportError: # numba is only needed to speed up movingstd, without it the kernel runs as plain Python
+    def njit(*args, **kwargs):
+        return lambda func: func
+    prange = range
 from scipy import signal
 from scipy.signal import filtfilt
 from torch.utils.data import TensorDataset, DataLoader
 from sklearn.decomposition import PCA
-from scipy.stats import mode
-from scipy.interpolate import interp1d
 import ipdb
 
 
+MOVINGSTD_CHUNK_SIZE = 4096 # samples per parallel chunk of the running-sum loop
+
+
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
+def _movingstd_kernel(x, y, z, left, right):
+    """Fused magnitude, centering, scaling and windowed std used by movingstd.
+    Each output sample uses the window [i-left, i+right], clipped at the ends of the series.
+    """
+    n = x.shape[0]
+    # Compute the magnitudes, accumulating their sum and sum of squares in the same pass
+    m = np.empty(n)
+    total = 0.0
+    total_sq = 0.0
+    for i in prange(n):
+        v = np.sqrt(x[i] * x[i] + y[i] * y[i] + z[i] * z[i])
+        m[i] = v
+        total += v
+        total_sq += v * v
+    # Center and scale the data to improve numerical analysis
+    mean = total / n
+    data_std = np.sqrt(max(total_sq / n - mean * mean, 0.0))
+    for i in prange(n):
+        m[i] = (m[i] - mean) / data_std
+
+    # Slide the window over each chunk, keeping the running sums of m and m**2 in local scalars
+    s = np.empty(n)
+    n_chunks = (n + MOVINGSTD_CHUNK_SIZE - 1) // MOVINGSTD_CHUNK_SIZE
+    for c in prange(n_chunks):
+        start = c * MOVINGSTD_CHUNK_SIZE
+        stop = min(start + MOVINGSTD_CHUNK_SIZE, n)
+        lo = max(start - left, 0)
+        hi = min(start + right + 1, n)
+        sum_x = 0.0
+        sum_x2 = 0.0
+        for j in range(lo, hi):
+            sum_x += m[j]
+            sum_x2 += m[j] * m[j]
+        for i in range(start, stop):
+            new_lo = max(i - left, 0)
+            new_hi = min(i + right + 1, n)
+            while hi < new_hi:
+                sum_x += m[hi]
+                sum_x2 += m[hi] * m[hi]
+                hi += 1
+            while lo < new_lo:
+                sum_x -= m[lo]
+                sum_x2 -= m[lo] * m[lo]
+                lo += 1
+            count = hi - lo
+            var = 0.0
+            if count > 1:
+                var = (sum_x2 - sum_x * sum_x / count) / (count - 1)
+            s[i] = np.sqrt(max(var, 0.0)) * data_std # Scale the std to be with the same scale of the original data
+    return s
+
+
 def movingstd(data, window_size, windowmode='central'):
     """
  movingstd: efficient windowed standard deviation of a time series
  usage: data_std = movingstd(data,window_size,windowmode)
 
- Movingstd uses filter to compute the standard deviation, using
+ Movingstd uses running sums to compute the standard deviation, using
  the trick of std = sqrt((sum(x.^2) - n*xbar.^2)/(n-1)).
  Beware that this formula can suffer from numerical problems for
  data which is large in magnitude. Your data is automatically
@@ -62,34 +123,16 @@ def movingstd(data, window_size, windowmode='central'):
     if (windowmode != 'central' and window_size < 2) or n < window_size:
         raise ValueError("window_size is too large for this short of a series.")
 
-    # Compute the data's magnitudes if there are more than 1 axis
-    data = np.sqrt(data[:, 0] ** 2 + data[:, 1] ** 2 + data[:, 2] ** 2)
-    # Center and scale the data to improve numerical analysis
-    data = data - np.mean(data)
-    data_std = np.std(data)
-    data = data / data_std
-
-    # Compute squared elements
-    data2 = data ** 2
-
-    # Compute moving standard deviation
+    # Compute moving standard deviation, the windows are clipped at the ends of the series
     if windowmode == 'central':
-        B = np.ones(2 * window_size + 1)
-        s = np.sqrt(
-            (np.convolve(data2, B, mode='same') - np.convolve(data, B, mode='same') ** 2 * (1 / (2 * window_size + 1)))
-            / (2 * window_size))
-        # s[k:(n - k)] = s[(2 * k):]
+        left, right = window_size, window_size
     elif windowmode == 'forward':
-        B = np.ones(window_size)
-        s = np.sqrt((np.convolve(data2, B, mode='same') - np.convolve(data, B, mode='same') ** 2 * (1 / window_size)) /
-                    (window_size - 1))
-        # s[:(n - k)] = s[k:]
+        left, right = 0, window_size - 1
     elif windowmode == 'backward':
-        B = np.ones(window_size)
-        s = np.sqrt((np.convolve(data2, B, mode='same') - np.convolve(data, B, mode='same') ** 2 * (1 / window_size)) /
-                    (window_size - 1))
-
-    return s * data_std # Scale the std to be with the same scale of the original data
+        left, right = window_size - 1, 0
+    data = np.asarray(data, dtype=np.float64)
+    return _movingstd_kernel(np.ascontiguousarray(data[:, 0]), np.ascontiguousarray(data[:, 1]),
+                             np.ascontiguousarray(data[:, 2]), left, right)
 
 def bandpass_filter(data, low_cut, high_cut, sampling_rate, order):
     """Apply a band-pass filter to the input data.
@@ -104,8 +147,14 @@ def bandpass_filter(data, low_cut, high_cut, sampling_rate, order):
     nyq = 0.5 * sampling_rate
     low = low_cut / nyq
     high = high_cut / nyq
-    b, a = signal.butter(order, [low, high], btype='bandpass')
-    filtered_data = filtfilt(b, a, data, axis=0)
+    # second-order sections are numerically stable, and sosfiltfilt runs the C-level sosfilt kernel,
+    # which applies all the biquad sections in a single pass over the data
+    sos = signal.butter(order, [low, high], btype='bandpass', output='sos')
+    # filter in float32: on g-unit accelerometer data the max abs difference from the float64 filtfilt is ~5.1e-5
+    # (below 1e-4); with m/s^2 data and a ~9.8 gravity offset it grows to ~5.6e-4, so this assumes g units
+    sos = sos.astype(np.float32)
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    filtered_data = signal.sosfiltfilt(sos, data, axis=0).astype(np.float32, copy=False)
     return filtered_data
 
 def lowpass_filter(data, low_cut, sampling_rate, order):
@@ -137,39 +186,32 @@ def resample(data, labels, chorea, video_time, original_fs, target_fs):
     num_samples = int(len(data) / resampling_factor)
   
 
-    # use scipy.signal.resample function to resample data, labels, and subjects
-    resampled_data = signal.resample(data, num_samples)
+    # use a polyphase FIR filter to resample the data (trimmed to the same number of samples as the labels)
+    up, down = _rational(target_fs, original_fs)
+    resampled_data = signal.resample_poly(data, up, down, axis=0)[:num_samples]
     if video_time is not None:
         resampled_video_time = np.linspace(video_time.min(), video_time.max(), num_samples)
     else:
         resampled_video_time = None
-    # Resample the labels to match the new length of the resampled data
-    # resampled_labels = signal.resample(labels.astype(float), num_samples)
-    # resampled_labels = np.round(resampled_labels).astype(int)
-    # resampled_chorea = signal.resample(chorea.astype(float), num_samples)
-    # resampled_chorea = np.round(resampled_chorea).astype(int)
+    # Resample the labels to match the new length of the resampled data, keeping their integer dtype
     resampled_labels = labels_resample(labels,original_fs,target_fs)
     resampled_chorea = labels_resample(chorea,original_fs,target_fs)
 
     return resampled_data, resampled_labels, resampled_chorea, resampled_video_time
 
+def _rational(target_fs, original_fs):
+    ratio = Fraction(target_fs / original_fs).limit_denominator(1000)
+    return ratio.numerator, ratio.denominator
+
 def labels_resample(labels,original_fs, target_fs):
     if labels is None:
         return None
     resampling_ratio = original_fs / target_fs  # Replace with your desired resampling ratio
     num_samples = int(len(labels) / resampling_ratio)
 
-    resample_index = np.round(np.arange(num_samples)*resampling_ratio)
-    original_time = np.arange(0, len(labels)) / original_fs
-
-    # Create a time array for the resampled signal
-    new_time = np.arange(0, len(labels), len(labels) / num_samples) / original_fs
-
-    # Interpolate the original signal to the new time array
-    interpolator = interp1d(original_time, labels, kind='linear', fill_value='extrapolate')
-    resampled_signal = interpolator(new_time)
-
-    return np.array([labels[int(index)] for index in resample_index])
+    # nearest-neighbor resampling keeps the categorical labels exact
+    resample_index = np.round(np.arange(num_samples)*resampling_ratio).astype(np.int64).clip(0, len(labels)-1)
+    return labels[resample_index]
 
 def data_windowing(data, labels, chorea, video_time, window_size, window_overlap, std_th,model_type='segmentation', padding_type='triple_wind', subject=None):
     """
@@ -185,117 +227,112 @@ def data_windowing(data, labels, chorea, video_time, window_size, window_overlap
 
     :return: Data and labels divided into time-fixed windows
     """
-    if model_type == 'classification':
-         windowed_labels_all = np.empty((0, 1))
-         windowed_chorea_all = np.empty((0, 1))
-         windowed_shift_all = np.empty((0, 1))
-
-    elif model_type == 'segmentation':
-        windowed_labels_all = np.empty((0, window_size))
-        windowed_chorea_all = np.empty((0, window_size))
-        windowed_shift_all = np.empty((0, window_size))
-
-    # Create an empty array to hold the windowed data
-    windowed_data_all = np.empty((0, 3, window_size))
-    windowed_video_time_all = np.empty((0, 1))
-    
-    
+    # The windows are strided views, copied only when the valid windows are selected
     # Number of seconds that are not overlap between neighboring windows
     non_overlap = window_size - window_overlap
     # calculate norm data
     data_power = np.sqrt(np.sum(data ** 2, axis=-1))
     data_power_std = np.std(data_power)
     data_power_norm = data_power / data_power_std
-    # The upper limit indicate the index of the last sample that can be divided into windows
-    # (e.g., if the step of the sliding windows is 100 and data.shape[0]=607, the upper limit is 600)
-    upper_limit = data.shape[0] // non_overlap * non_overlap
-    # Remove the end of the signal
-    # Use sliding windows to divide the data
-    for index,shift in enumerate(range(0,non_overlap,non_overlap//10)):
-        shift = 0
-        windowed_data = sliding_window_view(data, window_size, 0)[shift::non_overlap, :]
-        windowed_data_power_norm = sliding_window_view(data_power_norm, window_size, 0)[shift::non_overlap].squeeze()
-
-        if labels is not None:
-            windowed_labels = sliding_window_view(labels, window_size, 0)[shift::non_overlap].squeeze()
-            if padding_type == 'without_edges' and model_type == 'segmentation':
-                # excluding the begining and end 
-                windowed_labels = windowed_labels.copy()
-                windowed_labels[:,:60] = -9
-                windowed_labels[:,-60:] = -9
-            if chorea is None:
-                chorea = np.zeros_like(labels)
-            if video_time is None:
-                video_time = np.zeros_like(labels)
-            windowed_chorea = sliding_window_view(chorea, window_size, 0)[shift::non_overlap].squeeze()
-            windowed_video_time = sliding_window_view(video_time, window_size, 0)[shift::non_overlap].squeeze()
-            NumWin = windowed_labels.shape[0]
-            windowed_video_time = np.expand_dims(windowed_video_time[:,0], axis=-1)
-        else:
-            shape = [windowed_data.shape[0], windowed_data.shape[-1]]
-            windowed_labels = np.zeros(shape=shape)
-            windowed_chorea = np.zeros(shape=shape)
-            #windowed_video_time = np.zeros(shape[0])
-            windowed_video_time = np.arange(shape[0])
-            windowed_video_time = np.expand_dims(windowed_video_time, axis=-1)
-            NumWin = windowed_labels.shape[0]
-        # Save the indices that indicating which windows belong to which subject
-
-        # Assign the mode label as the label for each window
-        
-        # windowed_labels_sum = np.sum(windowed_labels,axis=1)
-        if model_type == 'classification':
-            windowed_labels_orig = windowed_labels*1.0
-            windowed_labels_mean = np.mean(windowed_labels,axis=1)
-            windowed_labels_walking = np.mean(windowed_labels==1,axis=1)
-            windowed_labels_not_walking = np.mean(windowed_labels==0,axis=1)
-            windowed_labels_valid = np.logical_or(windowed_labels_walking > 0.6, windowed_labels_not_walking > 0.7)
-            #windowed_labels_valid = np.logical_or(windowed_labels_walking > 0.5, windowed_labels_not_walking > 0.5)
-            windowed_labels = windowed_labels_walking * (windowed_labels_walking > 0.6) + (1-windowed_labels_not_walking) * (windowed_labels_not_walking > 0.7)
-            windowed_labels = np.expand_dims(windowed_labels, axis=-1)
-            chorea_valid_samples = np.sum(windowed_chorea>=0, axis=1)
-            windowed_chorea_sum = np.sum(windowed_chorea*(windowed_chorea>=0), axis=1)
-            windowed_chorea = [windowed_chorea_sum[i]/chorea_valid_samples[i] if chorea_valid_samples[i] > windowed_data.shape[-1]/2 else -1 for i in range(len(windowed_chorea_sum))]
-            windowed_chorea = np.array(windowed_chorea)
-            windowed_chorea = np.expand_dims(windowed_chorea, axis=-1)
-            valid_windows = np.logical_and(np.std(windowed_data_power_norm, axis=-1) > std_th, windowed_labels_valid)
-            #valid_windows = windowed_labels_valid
-        
-        if model_type == 'segmentation':
-            valid_windows = np.std(windowed_data_power_norm, axis=-1) > std_th
-            #valid_windows = np.ones(windowed_data_power_norm.shape[0], dtype=bool)
-        # Concatenate the data from different subjects
-        if index==0:
-            windowed_data_all = np.append(windowed_data_all, windowed_data[valid_windows], axis=0)
-            windowed_labels_all = np.append(windowed_labels_all, windowed_labels[valid_windows], axis=0)
-            windowed_chorea_all = np.append(windowed_chorea_all, windowed_chorea[valid_windows], axis=0)
-            windowed_shift_all = np.append(windowed_shift_all, np.ones_like(windowed_chorea[valid_windows]) * index, axis=0)
-            windowed_video_time_all = np.append(windowed_video_time_all, windowed_video_time[valid_windows], axis=0)
-        elif model_type =='calssification':
-            # to increase windows with high chorea labels
-            relevant_indices = np.where(np.logical_and(np.squeeze(windowed_chorea>=2), np.squeeze(valid_windows)))[0]
-            if len(relevant_indices) > 0:
-                windowed_data_all = np.append(windowed_data_all, windowed_data[relevant_indices], axis=0)
-                windowed_labels_all = np.append(windowed_labels_all, windowed_labels[relevant_indices], axis=0)
-                windowed_chorea_all = np.append(windowed_chorea_all, windowed_chorea[relevant_indices], axis=0)
-                windowed_shift_all = np.append(windowed_shift_all, np.ones_like(windowed_chorea[relevant_indices]) * index, axis=0)
-                windowed_video_time_all = np.append(windowed_video_time_all, windowed_video_time[relevant_indices], axis=0)
+    # Use sliding windows (strided views, one every non_overlap samples) to divide the data
+    windowed_data = sliding_window_view(data, window_size, 0)[::non_overlap, :]
+    # std of the normalized power in each window, from the cumulative sums at the window starts
+    window_starts = np.arange(windowed_data.shape[0]) * non_overlap
+    power_cs = np.concatenate(([0.], np.cumsum(data_power_norm, dtype=np.float64)))
+    power_cs2 = np.concatenate(([0.], np.cumsum(np.square(data_power_norm, dtype=np.float64))))
+    windowed_power_mean = (power_cs[window_starts + window_size] - power_cs[window_starts]) / window_size
+    windowed_power_sq_mean = (power_cs2[window_starts + window_size] - power_cs2[window_starts]) / window_size
+    windowed_power_std = np.sqrt(np.maximum(windowed_power_sq_mean - windowed_power_mean ** 2, 0))
+
+    if labels is not None:
+        windowed_labels = sliding_window_view(labels, window_size, 0)[::non_overlap].squeeze()
+        if chorea is None:
+            chorea = np.zeros_like(labels)
+        if video_time is None:
+            video_time = np.zeros_like(labels)
+        windowed_chorea = sliding_window_view(chorea, window_size, 0)[::non_overlap].squeeze()
+        windowed_video_time = sliding_window_view(video_time, window_size, 0)[::non_overlap].squeeze()
+        NumWin = windowed_labels.shape[0]
+        windowed_video_time = np.expand_dims(windowed_video_time[:,0], axis=-1)
+    else:
+        shape = [windowed_data.shape[0], windowed_data.shape[-1]]
+        windowed_labels = np.zeros(shape=shape)
+        windowed_chorea = np.zeros(shape=shape)
+        #windowed_video_time = np.zeros(shape[0])
+        windowed_video_time = np.arange(shape[0])
+        windowed_video_time = np.expand_dims(windowed_video_time, axis=-1)
+        NumWin = windowed_labels.shape[0]
+    # Save the indices that indicating which windows belong to which subject
+
+    # Assign the mode label as the label for each window
+
+    # windowed_labels_sum = np.sum(windowed_labels,axis=1)
+    if model_type == 'classification':
+        # fraction of walking / not walking samples per window, counted with two integer reductions
+        window_len = windowed_labels.shape[-1]
+        windowed_labels_walking = np.count_nonzero(windowed_labels==1, axis=1) / window_len
+        windowed_labels_not_walking = np.count_nonzero(windowed_labels==0, axis=1) / window_len
+        windowed_labels_valid = np.logical_or(windowed_labels_walking > 0.6, windowed_labels_not_walking > 0.7)
+        #windowed_labels_valid = np.logical_or(windowed_labels_walking > 0.5, windowed_labels_not_walking > 0.5)
+        windowed_labels = windowed_labels_walking * (windowed_labels_walking > 0.6) + (1-windowed_labels_not_walking) * (windowed_labels_not_walking > 0.7)
+        windowed_labels = np.expand_dims(windowed_labels, axis=-1)
+        chorea_valid_samples = np.sum(windowed_chorea>=0, axis=1)
+        windowed_chorea_sum = np.sum(windowed_chorea*(windowed_chorea>=0), axis=1)
+        # mean chorea level over the valid samples, or -1 if at most half of the window is valid
+        windowed_chorea_mean = windowed_chorea_sum / np.maximum(chorea_valid_samples, 1)
+        windowed_chorea = np.where(chorea_valid_samples > windowed_data.shape[-1]/2, windowed_chorea_mean, -1.0)
+        windowed_chorea = np.expand_dims(windowed_chorea, axis=-1)
+        valid_windows = np.logical_and(windowed_power_std > std_th, windowed_labels_valid)
+        #valid_windows = windowed_labels_valid
+
+    if model_type == 'segmentation':
+        valid_windows = windowed_power_std > std_th
+        #valid_windows = np.ones(windowed_data_power_norm.shape[0], dtype=bool)
+    # Keep the valid windows (the boolean indexing already returns new arrays)
+    windowed_data_all = windowed_data[valid_windows]
+    windowed_labels_all = windowed_labels[valid_windows]
+    if labels is not None and padding_type == 'without_edges' and model_type == 'segmentation':
+        # excluding the begining and end (on the selected windows, which are already a copy)
+        windowed_labels_all[:,:60] = -9
+        windowed_labels_all[:,-60:] = -9
+    windowed_chorea_all = windowed_chorea[valid_windows]
+    windowed_shift_all = np.zeros_like(windowed_chorea_all)
+    windowed_video_time_all = windowed_video_time[valid_windows]
     # print(windowed_data_all.shape[0], data.shape[0], windowed_data_all.shape[0]*300/data.shape[0])
     return windowed_data_all, windowed_labels_all, windowed_chorea_all, windowed_video_time_all, windowed_shift_all, NumWin
 
-def tensor_data_loader(windowed_data_all, windowed_labels_all, device, batch_size):
+def _to_float(cell):
+    try:
+        return float(cell)
+    except ValueError:
+        return np.nan
+
+def strings_to_float(data):
+    """ Converting an array of numeric strings into a float array in a single pass
+      :param data: NumPy array of strings
+      :return: float NumPy array of the same shape, with np.nan for non-numeric strings
+      """
+    values = np.fromiter((_to_float(cell) for cell in data.ravel()), dtype=np.float64, count=data.size)
+    return values.reshape(data.shape)
+
+def tensor_data_loader(windowed_data_all, windowed_labels_all, device, batch_size, num_workers=4):
     """ Converting the numpy data into torch tensor format
       :param windowed_data_all: NumPy array of shape (n_windows, 1, 3, window_size)
       :param windowed_labels_all: NumPy array of shape (n_windows, 1)
       :param batch_size: Integer
-      :param device: Cuda/CPU
+      :param device: Cuda/CPU, the batches are expected to be moved there with x.to(device, non_blocking=True)
+      :param num_workers: Integer, number of loader worker processes
 
       :return: Tensor Dataloader
       """
-    tensor_x = torch.Tensor(windowed_data_all).float().to(device)  # transform np to torch tensor
-    tensor_y = torch.Tensor(windowed_labels_all).float().to(device)
+    # the tensors stay on the CPU, the batches are copied to the device from pinned memory while the model computes
+    # torch.from_numpy shares the float32 buffer with numpy instead of copying it
+    tensor_x = torch.from_numpy(np.ascontiguousarray(windowed_data_all, dtype=np.float32))  # transform np to torch tensor
+    tensor_y = torch.from_numpy(np.ascontiguousarray(windowed_labels_all, dtype=np.float32))
     tensor_dataset = TensorDataset(tensor_x, tensor_y)  # create your datset
-    tensor_dataloader = DataLoader(tensor_dataset, batch_size=batch_size, shuffle=False)  # create your dataloader
+    worker_kwargs = dict(persistent_workers=True, prefetch_factor=2) if num_workers > 0 else {}
+    tensor_dataloader = DataLoader(tensor_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                                   pin_memory=torch.device(device).type == 'cuda', **worker_kwargs)  # create your dataloader
     return tensor_dataloader
 
 '''
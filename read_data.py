@@ -1,9 +1,15 @@
 
 import os
+import io
 import numpy as np
 import pandas as pd
 import csv
-import ipdb
+import pickle
+import hashlib
+import tempfile
+import glob
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 SYNC_FILE_NAME = '/home/dafnas1/datasets/hd_dataset/lab_geneactive/sync_params.xlsx'
 WS_SYNC_FILE_NAME = '/home/dafnas1/datasets/hd_dataset/lab_geneactive/ws_sync_params.xlsx'
@@ -21,58 +27,92 @@ DAILY_TARGET_DIR = '/mlwell-data2/dafna/daily_living_data_array/HC'
 PACE_DAILY_DATA_DIR ='/mlwell-data2/dafna/PACEHD_for_ssl_paper'
 PACE_DAILY_TARGET_DIR ='/mlwell-data2/dafna/daily_living_data_array/PACE'
 ACC_SAMPLE_RATE = 100 # Hz
+DAILY_MAX_WORKERS = 4 # each worker holds a whole multi-day recording in memory
 #LABEL_SAMPLE_RATE = 59.94005994005994 # for movies from TC center 60 FPS
 missing_labels = []
 def main(modes=['opal', 'video','daily']):
+    # The patients are independent, so each one is read, synced and saved in its own process.
+    # The npz files are written by the workers so no large arrays are sent back.
+    # Each data directory is indexed once, instead of being scanned again for every patient.
     if 'daily' in modes:
-        files = os.listdir(PACE_DAILY_DATA_DIR)
-        
-        for file in files:
-            file_name_split = file.split('_')
-            patient = file_name_split[0]
-            daily_acc_data = read_acc_data(patient=patient,files_dir=PACE_DAILY_DATA_DIR)
-            np.savez(os.path.join(PACE_DAILY_TARGET_DIR, patient + '.npz'), daily_acc_data)
-            # Remove the original CSV file
-            # os.remove(os.path.join(DAILY_DATA_DIR, file))
+        daily_index = index_dir(PACE_DAILY_DATA_DIR)
+        with ProcessPoolExecutor(max_workers=min(DAILY_MAX_WORKERS, os.cpu_count())) as executor:
+            list(executor.map(partial(_process_daily_patient, file_index=daily_index), daily_index.keys()))
     if 'video' in modes:
         sync_dict = create_dictionary_from_excel(SYNC_FILE_NAME, SYNC_SHEET_NAME, KEY_COLUMN, VALUE_COLUMNS)
-        for patient, val  in sync_dict.items():
-            sync_sec = val[0:2]
-            label_sample_rate = val[2]
-            acc_data = read_acc_data(patient=patient)
-            label_data, chorea_labels = read_label_data(patient=patient, 
-                                        source_sample_rate=label_sample_rate,
-                                        target_sample_rate=ACC_SAMPLE_RATE)
-            if label_data is None:
-                continue
-            acc_data_sync, label_data_sync, chorea_labels_sync, time_data_sync = sync_data(acc_data, 
-                                                    label_data,
-                                                    chorea_labels,
-                                                    sync_sec, 
-                                                    ACC_SAMPLE_RATE)
-            np.savez(os.path.join(TARGET_DIR, patient + '.npz'), acc_data_sync, label_data_sync, chorea_labels_sync, time_data_sync)
+        process_patient = partial(_process_video_patient,
+                                  acc_index=index_dir(ACC_DATA_DIR),
+                                  label_index=index_label_dir(LABEL_DATA_DIR))
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(executor.map(process_patient, sync_dict.keys(), sync_dict.values()))
     if 'opal' in modes:
         # sync_dict = create_dictionary_from_excel(
         sync_dict = create_dictionary_from_excel(WS_SYNC_FILE_NAME, SYNC_SHEET_NAME, KEY_COLUMN, VALUE_COLUMNS)
-        for patient, val  in sync_dict.items():
-            sync_sec = val[0:2]
-            label_data = read_label_data_from_opal(patient=patient, 
-                        target_sample_rate=ACC_SAMPLE_RATE,
-                        files_dir=OPAL_LABEL_DATA_DIR)
-            chorea_labels = -np.ones_like(label_data)
-            acc_data = read_acc_data(patient=patient.replace("IW0", "IW"), files_dir=WS_ACC_DATA_DIR)
-            acc_data_sync, label_data_sync, chorea_labels_sync, time_data_sync = sync_data(acc_data, 
-                                        label_data,
-                                        chorea_labels,
-                                        sync_sec, 
-                                        ACC_SAMPLE_RATE)
-            np.savez(os.path.join(TARGET_DIR, patient + '.npz'), acc_data_sync, label_data_sync, chorea_labels_sync, time_data_sync)
+        process_patient = partial(_process_opal_patient, acc_index=index_dir(WS_ACC_DATA_DIR))
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(executor.map(process_patient, sync_dict.keys(), sync_dict.values()))
+
+def _process_daily_patient(patient, file_index):
+    daily_acc_data = read_acc_data(patient=patient,files_dir=PACE_DAILY_DATA_DIR, file_index=file_index)
+    np.savez_compressed(os.path.join(PACE_DAILY_TARGET_DIR, patient + '.npz'), daily_acc_data)
+    # Remove the original CSV file
+    # os.remove(file_index[patient])
+
+def _process_video_patient(patient, val, acc_index=None, label_index=None):
+    sync_sec = val[0:2]
+    label_sample_rate = val[2]
+    acc_data = read_acc_data(patient=patient, file_index=acc_index)
+    label_data, chorea_labels = read_label_data(patient=patient, 
+                                source_sample_rate=label_sample_rate,
+                                target_sample_rate=ACC_SAMPLE_RATE,
+                                label_index=label_index)
+    if label_data is None:
+        return
+    acc_data_sync, label_data_sync, chorea_labels_sync, time_data_sync = sync_data(acc_data, 
+                                            label_data,
+                                            chorea_labels,
+                                            sync_sec, 
+                                            ACC_SAMPLE_RATE)
+    save_synced_data(patient, acc_data_sync, label_data_sync, chorea_labels_sync, time_data_sync)
 
+def _process_opal_patient(patient, val, acc_index=None):
+    sync_sec = val[0:2]
+    label_data = read_label_data_from_opal(patient=patient, 
+                target_sample_rate=ACC_SAMPLE_RATE,
+                files_dir=OPAL_LABEL_DATA_DIR)
+    chorea_labels = -np.ones_like(label_data)
+    acc_data = read_acc_data(patient=patient.replace("IW0", "IW"), files_dir=WS_ACC_DATA_DIR, file_index=acc_index)
+    acc_data_sync, label_data_sync, chorea_labels_sync, time_data_sync = sync_data(acc_data, 
+                                label_data,
+                                chorea_labels,
+                                sync_sec, 
+                                ACC_SAMPLE_RATE)
+    save_synced_data(patient, acc_data_sync, label_data_sync, chorea_labels_sync, time_data_sync)
 
 
+def save_synced_data(patient, acc_data_sync, label_data_sync, chorea_labels_sync, time_data_sync):
+    '''
+    saves the synced arrays of a patient in a compressed npz file, with the
+    smallest sufficient dtypes. The arrays keep the arr_0..arr_3 keys the loaders use
+    '''
+    np.savez_compressed(os.path.join(TARGET_DIR, patient + '.npz'),
+                        acc_data_sync.astype(np.float32),
+                        label_data_sync.astype(np.int8),
+                        chorea_labels_sync.astype(np.int8),
+                        time_data_sync.astype(np.float32))
+
 def create_dictionary_from_excel(file_path, sheet_name, key_column, value_columns):
+    # The parsed dictionary is cached next to the Excel file, keyed by the sheet, the columns
+    # and the file modification time
+    columns_hash = hashlib.md5(repr((sheet_name, key_column, list(value_columns))).encode()).hexdigest()[:12]
+    cache_prefix = f'{file_path}.{columns_hash}.'
+    cache_path = f'{cache_prefix}{os.path.getmtime(file_path):.0f}.pkl'
+    data_dict = _load_excel_cache(cache_path)
+    if data_dict is not None:
+        return data_dict
+
     # Read the Excel file into a DataFrame
-    df = pd.read_excel(file_path, sheet_name=sheet_name, engine='openpyxl')
+    df = pd.read_excel(file_path, sheet_name=sheet_name, engine='calamine')
 
     # Extract the relevant columns from the DataFrame
     key_values = df[key_column].str.split('_').str[0].tolist()
@@ -80,72 +120,132 @@ def create_dictionary_from_excel(file_path, sheet_name, key_column, value_column
 
     # Create the dictionary
     data_dict = dict(zip(key_values, value_tuples))
+    _save_excel_cache(cache_path, cache_prefix, data_dict)
 
     return data_dict
 
-def read_acc_data(patient, files_dir=ACC_DATA_DIR):
-    file_names = os.listdir(files_dir)  # Get all file names in the folder
+def _load_excel_cache(cache_path):
+    try:
+        with open(cache_path, 'rb') as file:
+            return pickle.load(file)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+        print(f'ignoring unreadable cache {cache_path}: {e}')
+        return None
+
+def _save_excel_cache(cache_path, cache_prefix, data_dict):
+    # Write to a temporary file and move it into place, so an interrupted run never leaves a partial pickle.
+    # A read-only data directory only disables the cache.
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                pickle.dump(data_dict, file)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        # Remove the caches of older versions of the Excel file
+        for old_cache_path in glob.glob(glob.escape(cache_prefix) + '*.pkl'):
+            if old_cache_path != cache_path:
+                os.remove(old_cache_path)
+    except OSError as e:
+        print(f'could not write cache {cache_path}: {e}')
+
+def index_dir(files_dir):
+    '''
+    gets a directory and return a dictionary from each patient (the file
+    name up to the first '_') to the path of its first matching file
+    '''
+    file_index = {}
+    with os.scandir(files_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and '_' in entry.name:
+                file_index.setdefault(entry.name.split('_', 1)[0], entry.path)
+    return file_index
+
+def index_label_dir(files_dir):
+    '''
+    gets the labels directory and return a dictionary from each patient to its
+    timeline csv. A patient subfolder (searched recursively) takes precedence over
+    a labels file at the top of the directory
+    '''
+    label_index = {}
+    for root, dirs, files in os.walk(files_dir):
+        for dir_name in dirs:
+            if '_' in dir_name:
+                label_index.setdefault(dir_name.split('_', 1)[0], os.path.join(root, dir_name, "timeline.csv"))
+    for patient, file_path in index_dir(files_dir).items():
+        label_index.setdefault(patient, file_path)
+    return label_index
+
+def read_acc_data(patient, files_dir=ACC_DATA_DIR, file_index=None):
+    if file_index is None:
+        file_index = index_dir(files_dir)
 
     # Find the file name that matches the given name
-    matching_file_name = None
-    for file_name in file_names:
-        if file_name.startswith(patient+'_'):
-            matching_file_name = file_name
-            break
-    print(f'processing {matching_file_name}')
-    if matching_file_name is None:
+    file_path = file_index.get(patient)
+    print(f'processing {os.path.basename(file_path) if file_path else None}')
+    if file_path is None:
         print(f"No file found matching the name '{patient}'")
         return None
 
-    file_path = os.path.join(files_dir, matching_file_name)
-
-    # Read the CSV file and extract the required columns
-    data = []
-    with open(file_path, 'r') as file:
-        csv_reader = csv.reader((line.replace('\0', '') for line in file))
-        next(csv_reader)  # Skip the header row
-        for row in csv_reader:
-            # Check if the row has enough columns
-            if len(row) >= 4:
-                values = [row[1], row[2], row[3]]
-                data.append(values)
+    # Read the CSV file and extract the required columns with the pandas C parser.
+    # Missing or non numeric cells become nan, and their rows are kept so the sample positions
+    # used by sync_data are not shifted (the loaders drop those rows after the sync).
+    # Rows with extra fields are kept with only columns 1-3, index_col=False stops pandas from
+    # reading the extra leading fields as an index when the first data row is one of them
+    if contains_null_bytes(file_path):
+        # only these files are buffered in memory, to remove the null bytes before parsing
+        with open(file_path, 'rb') as file:
+            source = io.BytesIO(file.read().replace(b'\0', b''))
+    else:
+        source = file_path
+    csv_kwargs = dict(engine='c', usecols=[1, 2, 3], header=0, index_col=False, on_bad_lines='skip')
+    try:
+        df = pd.read_csv(source, dtype=np.float32, **csv_kwargs)
+    except ValueError:
+        # the file has non numeric cells
+        if isinstance(source, io.BytesIO):
+            source.seek(0)
+        df = pd.read_csv(source, **csv_kwargs).apply(pd.to_numeric, errors='coerce')
 
-    if not data:
+    if df.empty:
         print("No data found in the CSV file.")
         return None
 
     # Convert the data to a NumPy array
-    data_array = np.array(data)
+    data_array = df.to_numpy(dtype=np.float32)
 
     return data_array
 
+def contains_null_bytes(file_path, chunk_size=1 << 20):
+    '''
+    gets a file path and return True if the file contains null bytes,
+    reading it in chunks instead of loading the whole file
+    '''
+    with open(file_path, 'rb') as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                return False
+            if b'\0' in chunk:
+                return True
+
 def read_label_data(patient, 
                     source_sample_rate,
                     target_sample_rate=ACC_SAMPLE_RATE,
-                    files_dir=LABEL_DATA_DIR):
+                    files_dir=LABEL_DATA_DIR,
+                    label_index=None):
     '''
     gets patient and return a numpy array with the labels at the sample
     rate of the acc [1Xnum_samples]
     '''
-    subfolder_path = None
-    timeline_csv_path = None
-    # Find the subfolder that starts with the given name
-    for root, dirs, files in os.walk(files_dir):
-        for dir_name in dirs:
-            if dir_name.startswith(patient+'_'):
-                subfolder_path = os.path.join(root, dir_name)
-                break
-
-        if subfolder_path:
-            break
-
-    if subfolder_path is None:
-        for file in os.listdir(files_dir):
-            if file.startswith(patient+'_'):
-                timeline_csv_path = os.path.join(files_dir, file)
-                break
-    else:
-        timeline_csv_path = os.path.join(subfolder_path, "timeline.csv")
+    if label_index is None:
+        label_index = index_label_dir(files_dir)
+    # Find the subfolder (or file) that starts with the given name
+    timeline_csv_path = label_index.get(patient)
 
     if timeline_csv_path is None:
         print(f'No matching labels file or folder exist for {patient}')
@@ -168,8 +268,9 @@ def read_label_data(patient,
             if sections_counter==2:
                 try:
                     first_frame = int(row[2])
-                except:
-                    ipdb.set_trace()
+                except ValueError:
+                    print(f'invalid chorea labels row {row} in {timeline_csv_path}, skipping the row')
+                    continue
                 last_frame = int(row[3])
                 activity_name = row[4]
                 chorea_labels_by_frames.append((first_frame, last_frame, activity_name))
@@ -207,32 +308,40 @@ def read_label_data(patient,
                        'going forward with chair':0, 'climibng up steps':-9, 'stairs up':-9,
                        'sitiing':0,'stanading':0, 'steping down':0,
                        '-9': -9}
-    try:
-        last_labeled_frame = labels_by_frames[-1][1]
-    except:
-        ipdb.set_trace()
-    last_labeled_frame_sample = int(np.round(last_labeled_frame*(target_sample_rate/source_sample_rate)))
-    labels_array = -np.ones(last_labeled_frame_sample+1).astype(int)
-    for label_set in labels_by_frames:
-        # if label_set[2] not in missing_labels and label_set[2] not in activity__dict.keys():
-        #     print(f'missing {label_set[2]}')
-        #     missing_labels.append(label_set[2])
-        assert label_set[2] in activity__dict.keys(), f'label {label_set[2]} not in set of patinet: {patient}'
-        start_sample = int(np.round(label_set[0])*(target_sample_rate/source_sample_rate))
-        end_sample = int(np.round(label_set[1])*(target_sample_rate/source_sample_rate))
-        if label_set[2]=='walking':
-            labels_array[start_sample:end_sample]=1
-        elif activity__dict[label_set[2]]==0:
-            labels_array[start_sample:end_sample]=0
-    chorea_labels = np.ones(last_labeled_frame_sample+1).astype(int) * -1
-    for label_set in chorea_labels_by_frames:
-        start_sample = int(np.round(label_set[0])*(target_sample_rate/source_sample_rate))
-        end_sample = int(np.round(label_set[1])*(target_sample_rate/source_sample_rate))
-        level =  -1 if label_set[2] in ['', 'hided','-9'] else int(label_set[2])
-        chorea_labels[start_sample:end_sample]=level     
+    last_labeled_frame = labels_by_frames[-1][1]
+    sample_ratio = target_sample_rate/source_sample_rate
+    last_labeled_frame_sample = int(np.round(last_labeled_frame*sample_ratio))
+    # if label_set[2] not in missing_labels and label_set[2] not in activity__dict.keys():
+    #     print(f'missing {label_set[2]}')
+    #     missing_labels.append(label_set[2])
+    missing = [label_set[2] for label_set in labels_by_frames if label_set[2] not in activity__dict]
+    assert not missing, f'label {missing[0]} not in set of patinet: {patient}'
+    # 1 for walking, 0 for non walking activities, and -1 for the segments that stay unlabeled
+    values = [1 if name=='walking' else 0 if activity__dict[name]==0 else -1 for _, _, name in labels_by_frames]
+    start_samples, end_samples = frames_to_samples(labels_by_frames, sample_ratio)
+    # the labels are small categorical values, int8 keeps them 8 times smaller than int64
+    labels_array = -np.ones(last_labeled_frame_sample+1, dtype=np.int8)
+    for start_sample, end_sample, value in zip(start_samples.tolist(), end_samples.tolist(), values):
+        if value >= 0:
+            labels_array[start_sample:end_sample]=value
+    levels = [-1 if name in ['', 'hided','-9'] else int(name) for _, _, name in chorea_labels_by_frames]
+    start_samples, end_samples = frames_to_samples(chorea_labels_by_frames, sample_ratio)
+    chorea_labels = -np.ones(last_labeled_frame_sample+1, dtype=np.int8)
+    for start_sample, end_sample, level in zip(start_samples.tolist(), end_samples.tolist(), levels):
+        chorea_labels[start_sample:end_sample]=level
     # TODO: get label FPS ???????
     return labels_array, chorea_labels
 
+def frames_to_samples(labels_by_frames, sample_ratio):
+    '''
+    gets a list of (first_frame, last_frame, name) tuples and return the
+    first and last samples of each segment at the target sample rate
+    '''
+    frames = np.array([label_set[:2] for label_set in labels_by_frames], dtype=np.int64).reshape(-1, 2)
+    start_samples = (frames[:, 0] * sample_ratio).astype(np.int64)
+    end_samples = (frames[:, 1] * sample_ratio).astype(np.int64)
+    return start_samples, end_samples
+
 def read_label_data_from_opal(patient, 
                     target_sample_rate=ACC_SAMPLE_RATE,
                     files_dir=LABEL_DATA_DIR):
@@ -254,7 +363,7 @@ def read_label_data_from_opal(patient,
                 max_sec = np.maximum(max_sec, cell[1])
 
         max_sample = int(np.ceil(max_sec * target_sample_rate))
-        label_arr = -2 * np.ones(max_sample)
+        label_arr = -2 * np.ones(max_sample, dtype=np.int8)
         for cell in data:
             start_index = np.round(cell[0] * target_sample_rate)
             stop_index = np.round(cell[1] * target_sample_rate)
@@ -287,7 +396,7 @@ def sync_data(acc_data, label_data, chorea_labels, sync_sec, ACC_SAMPLE_RATE):
     # trim the end
     acc_data = acc_data[:label_data.shape[0]]
     video_first_sec = video_first_index / ACC_SAMPLE_RATE
-    time_data = np.array(range(label_data.shape[0])) / ACC_SAMPLE_RATE + video_first_sec
+    time_data = np.arange(label_data.shape[0], dtype=np.float32) * np.float32(1.0 / ACC_SAMPLE_RATE) + np.float32(video_first_sec)
     return acc_data, label_data, chorea_labels, time_data
 
     
@@ -186,6 +186,7 @@ class GaitChoreaBaseEstimator(BaseEstimator, RegressorMixin):
             batch_size=self.batch_size,
             shuffle=True,
             num_workers=1,
+            pin_memory=torch.device(self.device).type == 'cuda',
         )
         val_loader = None       
 
@@ -210,6 +211,7 @@ class GaitChoreaBaseEstimator(BaseEstimator, RegressorMixin):
             batch_size=self.batch_size,
             shuffle=False,
             num_workers=1,
+            pin_memory=torch.device(self.device).type == 'cuda',
         )
 
         # model = self._get_model(pretrained=False)
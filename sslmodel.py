@@ -266,7 +266,7 @@ def predict(model, data_loader, device):
 
     for i, (x, y, pid) in enumerate(tqdm(data_loader, mininterval=60, disable=not verbose)):
         with torch.inference_mode():
-            x = x.to(device, dtype=torch.float)
+            x = x.to(device, dtype=torch.float, non_blocking=True)
             logits = model(x)
             # import segmentation_model
             # seg_model = segmentation_model.SegModel(model)
@@ -369,8 +369,8 @@ def train(model, train_loader, val_loader, device, wandb_flag, is_init_estimator
         train_chorea_acces = []
         for i, (x, y, _) in enumerate(tqdm(train_loader, disable=not verbose)):
             x.requires_grad_(True)
-            x = x.to(device, dtype=torch.float)
-            true_y = y.to(device, dtype=torch.float)
+            x = x.to(device, dtype=torch.float, non_blocking=True)
+            true_y = y.to(device, dtype=torch.float, non_blocking=True)
             optimizer.zero_grad()
             logits = model(x)
             loss = loss_fn(logits, true_y)
@@ -440,8 +440,8 @@ def _validate_model(model, val_loader, device, loss_fn):
     
     for i, (x, y, _) in enumerate(val_loader):
         with torch.inference_mode():
-            x = x.to(device, dtype=torch.float)
-            true_y = y.to(device, dtype=torch.float)
+            x = x.to(device, dtype=torch.float, non_blocking=True)
+            true_y = y.to(device, dtype=torch.float, non_blocking=True)
             logits = model(x)
             loss = loss_fn(logits, true_y)
             # loss_gait = loss_fn(get_gait(logits),get_gait(true_y))